@@ -1,23 +1,245 @@
-import mimetypes
+import codecs
+import json
+import os
 import re
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Tuple, Union
 
 import pathspec
 import typer
-from rich import print
+from rich import get_console, print
 from rich.syntax import Syntax
 from rich.text import Text
 from rich.tree import Tree
 
 app = typer.Typer()
 
+# Extensions whose files are known to be text or binary, checked before sniffing the file's content
+_TEXT_EXTENSIONS = frozenset({
+    'bat', 'c', 'cc', 'cfg', 'cmake', 'conf', 'cpp', 'cs', 'css', 'csv', 'cxx', 'dart', 'env', 'go', 'gradle',
+    'graphql', 'h', 'hpp', 'htm', 'html', 'ini', 'ipynb', 'java', 'js', 'json', 'jsx', 'kt', 'kts', 'less', 'lock',
+    'lua', 'm', 'md', 'mjs', 'php', 'pl', 'proto', 'ps1', 'py', 'pyi', 'pyx', 'r', 'rb', 'rs', 'rst', 'sass', 'scala',
+    'scss', 'sh', 'sql', 'svg', 'swift', 'tex', 'toml', 'ts', 'tsx', 'txt', 'vue', 'xml', 'yaml', 'yml', 'zsh',
+})
+_BINARY_EXTENSIONS = frozenset({
+    '7z', 'a', 'avi', 'bin', 'bmp', 'bz2', 'class', 'db', 'dll', 'dmg', 'doc', 'docx', 'dylib', 'eot', 'exe',
+    'flac', 'gif', 'gz', 'ico', 'iso', 'jar', 'jpeg', 'jpg', 'lib', 'mkv', 'mov', 'mp3', 'mp4', 'npy', 'npz', 'o',
+    'obj', 'ogg', 'otf', 'parquet', 'pdf', 'pickle', 'pkl', 'png', 'ppt', 'pptx', 'pyc', 'pyd', 'pyo', 'rar', 'so',
+    'sqlite', 'tar', 'tgz', 'tif', 'tiff', 'ttf', 'wav', 'webm', 'webp', 'whl', 'woff', 'woff2', 'xls', 'xlsx', 'xz',
+    'zip',
+})
+
+# Results of is_binary_file by path, so that every file is read at most once per run
+_binary_cache: Dict[str, bool] = {}
+
+# Compiled filter patterns: a single union of all patterns, or the patterns themselves when they cannot be joined
+Patterns = Union[re.Pattern, Tuple[re.Pattern, ...]]
+
 
 class FilteringError(Exception):
     """Custom exception for filtering errors."""
     pass
 
 
+@dataclass(frozen=True)
+class PathFilters:
+    """Compiled include and exclude filters of a single filter set (tree or content)."""
+    include_dirs: Optional[Patterns]
+    exclude_dirs: Optional[Patterns]
+    include_files: Optional[Patterns]
+    exclude_files: Optional[Patterns]
+    include_extensions: FrozenSet[str]
+    exclude_extensions: FrozenSet[str]
+    include_binary: bool
+
+    @classmethod
+    def compile(
+            cls,
+            include_dirs: List[str],
+            exclude_dirs: List[str],
+            include_files: List[str],
+            exclude_files: List[str],
+            include_extensions: List[str],
+            exclude_extensions: List[str],
+            include_binary: bool
+    ) -> "PathFilters":
+        """
+        Compile lists of filter patterns into a PathFilters object.
+
+        Within each kind of filter the include patterns take precedence over the exclude patterns, and file patterns
+        take precedence over extensions. Filters that can never be consulted are dropped, so that the remaining ones
+        can be applied in any order.
+
+        :param include_dirs: List of directory include patterns.
+        :param exclude_dirs: List of directory exclude patterns.
+        :param include_files: List of file include patterns.
+        :param exclude_files: List of file exclude patterns.
+        :param include_extensions: List of file extension include patterns.
+        :param exclude_extensions: List of file extension exclude patterns.
+        :param include_binary: Whether to include binary files.
+        :return: PathFilters object.
+        """
+        if include_dirs:
+            exclude_dirs = []
+        if include_files:
+            exclude_files = []
+        if include_files or exclude_files:
+            include_extensions = []
+            exclude_extensions = []
+        if include_extensions:
+            exclude_extensions = []
+
+        return cls(
+            include_dirs=compile_patterns(include_dirs),
+            exclude_dirs=compile_patterns(exclude_dirs),
+            include_files=compile_patterns(include_files),
+            exclude_files=compile_patterns(exclude_files),
+            include_extensions=normalize_extensions(include_extensions),
+            exclude_extensions=normalize_extensions(exclude_extensions),
+            include_binary=include_binary
+        )
+
+    def specialize(self) -> "EntryFilter":
+        """
+        Build functions applying these filters, specialized to the filters actually in use.
+
+        Unused filters are resolved once here instead of being checked on every call, and the compiled patterns are
+        bound as closure variables. The functions do not apply .gitignore rules, which scan_directory checks once for
+        every entry before filtering.
+
+        :return: EntryFilter object.
+        """
+        if self.include_dirs is not None:
+            search_dirs = search_function(self.include_dirs)
+
+            def accept_dir(relative_path: str) -> bool:
+                return search_dirs(relative_path) is not None
+        elif self.exclude_dirs is not None:
+            search_dirs = search_function(self.exclude_dirs)
+
+            def accept_dir(relative_path: str) -> bool:
+                return search_dirs(relative_path) is None
+        else:
+            def accept_dir(relative_path: str) -> bool:
+                return True
+
+        return EntryFilter(accept_dir, self._compile_accept_file())
+
+    def _compile_accept_file(self) -> Callable[[str, str, str], bool]:
+        """
+        Generate the file filter function from source containing only the checks of the filters in use.
+
+        The generated source is built from fixed code lines only. The compiled patterns and extension sets are passed
+        to a generated factory function, so they are bound as closure variables rather than embedded in the source.
+
+        :return: Function called with the path, relative path and name of a file.
+        """
+        # Cheapest checks first: extension set lookups, then regexes and finally the binary check, which opens the file
+        body = []
+        if self.include_extensions or self.exclude_extensions:
+            body.append("extension = splitext(name)[1][1:].lower()")
+        if self.include_extensions:
+            body.append("if extension not in include_extensions: return False")
+        if self.exclude_extensions:
+            body.append("if extension in exclude_extensions: return False")
+        if self.include_files is not None:
+            body.append("if include_search(name) is None and include_search(relative_path) is None: return False")
+        elif self.exclude_files is not None:
+            body.append("if exclude_search(name) is not None or exclude_search(relative_path) is not None: return False")
+        body.append("return True" if self.include_binary else "return not is_binary_file(path)")
+
+        arguments = {
+            "splitext": os.path.splitext,
+            "is_binary_file": is_binary_file,
+            "include_extensions": self.include_extensions,
+            "exclude_extensions": self.exclude_extensions,
+            "include_search": search_function(self.include_files) if self.include_files is not None else None,
+            "exclude_search": search_function(self.exclude_files) if self.exclude_files is not None else None,
+        }
+        source = "\n".join([
+            f"def make_accept_file({', '.join(arguments)}):",
+            "    def accept_file(path, relative_path, name):",
+            *(f"        {line}" for line in body),
+            "    return accept_file",
+        ])
+        namespace: Dict[str, Callable] = {}
+        exec(compile(source, "<accept_file>", "exec"), namespace)
+        return namespace["make_accept_file"](**arguments)
+
+
+@dataclass(frozen=True)
+class EntryFilter:
+    """Functions deciding whether a directory or a file passes a filter set."""
+    accept_dir: Callable[[str], bool]  # Called with the relative path of the directory
+    accept_file: Callable[[str, str, str], bool]  # Called with the path, relative path and name of the file
+
+
+@dataclass(frozen=True)
+class TreeNode:
+    """A file or directory that passed the tree filters."""
+    name: str
+    path: str
+    is_dir: bool
+    status: Optional[str] = None  # Marker shown next to a file: "empty", "binary" or "content"
+    include_content: bool = False  # Whether a directory passed the content directory filters
+
+
+def compile_patterns(patterns: List[str]) -> Optional[Patterns]:
+    """
+    Combine regex patterns into a single compiled pattern matching any of them.
+
+    Patterns with global inline flags such as (?i) cannot be joined, since the flags would have to apply to the whole
+    union, and neither can patterns with groups after the first one, since joining shifts their group numbers and
+    breaks numbered backreferences. Such patterns are compiled individually instead.
+
+    :param patterns: List of regex patterns.
+    :return: Compiled pattern, tuple of compiled patterns, or None if no patterns were given.
+    """
+    if not patterns:
+        return None
+    compiled = tuple(re.compile(pattern) for pattern in patterns)
+    if len(compiled) == 1:
+        return compiled[0]
+    if any(pattern.flags != re.UNICODE for pattern in compiled) or any(pattern.groups for pattern in compiled[1:]):
+        return compiled
+    try:
+        return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+    except re.error:  # E.g. the same group name in several patterns
+        return compiled
+
+
+def search_function(patterns: Patterns) -> Callable[[str], Optional[re.Match]]:
+    """
+    Get a function searching a string for the first match of compiled patterns.
+
+    :param patterns: Compiled pattern or tuple of compiled patterns, as returned by compile_patterns.
+    :return: Function returning the match, or None if no pattern matches.
+    """
+    if isinstance(patterns, re.Pattern):
+        return patterns.search
+    searches = [pattern.search for pattern in patterns]
+
+    def search(string: str) -> Optional[re.Match]:
+        for pattern_search in searches:
+            match = pattern_search(string)
+            if match is not None:
+                return match
+        return None
+    return search
+
+
+def normalize_extensions(extensions: List[str]) -> FrozenSet[str]:
+    """
+    Normalize file extensions to lowercase without a leading dot.
+
+    :param extensions: List of file extensions.
+    :return: Frozen set of normalized extensions.
+    """
+    return frozenset(extension.lstrip('.').lower() for extension in extensions)
+
+
 def validate_filters(include: List[str], exclude: List[str], name: str) -> None:
     """
     Validate that both include and exclude lists are not specified simultaneously.
@@ -31,170 +253,309 @@ def validate_filters(include: List[str], exclude: List[str], name: str) -> None:
         raise FilteringError(f"Error: Cannot specify both include and exclude for {name}. Please use only one.")
 
 
-def parse_gitignore(gitignore_path: Path) -> Optional[pathspec.PathSpec]:
+def parse_gitignore(gitignore_path: Path) -> Optional[pathspec.GitIgnoreSpec]:
     """
-    Parse a .gitignore file and return a PathSpec object.
+    Parse a .gitignore file and return a GitIgnoreSpec object.
 
     :param gitignore_path: Path to the .gitignore file.
-    :return: PathSpec object or None if the file does not exist.
+    :return: GitIgnoreSpec object or None if the file does not exist.
     """
     if not gitignore_path.exists():
         return None
     with gitignore_path.open() as gitignore_file:
-        spec = pathspec.PathSpec.from_lines('gitwildmatch', gitignore_file)
+        spec = pathspec.GitIgnoreSpec.from_lines(gitignore_file)
     return spec
 
 
-def is_binary_file(file_path: Path) -> bool:
+def is_binary_file(file_path: str) -> bool:
     """
     Check if a file is binary.
 
+    Well-known extensions are decided without touching the file; other files are binary if their first 1024 bytes
+    contain a NUL byte, the same heuristic git uses, or are not valid UTF-8.
+
     :param file_path: Path to the file.
     :return: True if the file is binary, False otherwise.
     """
-    mime_type, _ = mimetypes.guess_type(file_path)
-    if mime_type is None:
-        # If we can't determine the MIME type, try to read it as text
-        try:
-            with file_path.open('r') as f:
-                f.read(1024)
-            return False
-        except UnicodeDecodeError:
-            return True
-    return not mime_type.startswith('text')
-
+    extension = os.path.splitext(file_path)[1][1:].lower()
+    if extension in _TEXT_EXTENSIONS:
+        return False
+    if extension in _BINARY_EXTENSIONS:
+        return True
 
-def is_file_empty(file_path: Path) -> bool:
+    is_binary = _binary_cache.get(file_path)
+    if is_binary is None:
+        with open(file_path, 'rb') as f:
+            chunk = f.read(1024)
+        is_binary = b'\x00' in chunk
+        if not is_binary:
+            try:
+                # Unless the chunk is the whole file, it may end in the middle of a multi-byte character
+                codecs.getincrementaldecoder('utf-8')().decode(chunk, final=len(chunk) < 1024)
+            except UnicodeDecodeError:
+                is_binary = True
+        _binary_cache[file_path] = is_binary
+    return is_binary
+
+
+def is_file_empty(file_path: str, size: Optional[int] = None) -> bool:
     """
-    Check if a file is empty.
+    Check if a file is empty or contains only whitespace.
 
     :param file_path: Path to the file.
+    :param size: Size of the file in bytes, if already known.
     :return: True if the file is empty, False otherwise.
     """
-    if not file_path.is_file():
-        return False
-    if file_path.stat().st_size == 0:
+    if size is None:
+        size = os.stat(file_path).st_size
+    if size == 0:
         return True
     if is_binary_file(file_path):
         return False  # Assume binary files are not empty
-    return file_path.read_text().strip() == ''
+    # Stop at the first chunk with non-whitespace content instead of reading the whole file
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(65536):
+            if chunk.strip():
+                return False
+    return True
 
 
-def filter_path(
-        path: Path,
+def scan_directory(
+        dir_path: str,
+        root_len: int,
+        gitignore_spec: Optional[pathspec.GitIgnoreSpec],
+        tree_filter: EntryFilter,
+        content_filter: EntryFilter,
+        include_content: bool
+) -> List[TreeNode]:
+    """
+    Scan a single directory and return its entries that pass the tree filters.
+
+    :param dir_path: Path to the directory.
+    :param root_len: Length of the root path prefix sliced off entry paths to get relative paths.
+    :param gitignore_spec: GitIgnoreSpec object for .gitignore rules.
+    :param tree_filter: Filter for the tree.
+    :param content_filter: Filter for the content.
+    :param include_content: Whether the directory passed the content directory filters.
+    :return: List of tree nodes in directory order.
+    """
+    entries = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            # Symlinked directories are listed as leaves without being followed, to avoid cycles; broken links and
+            # special files are skipped
+            is_dir_link = not is_dir and not entry.is_file() and entry.is_symlink() and entry.is_dir()
+            if is_dir or is_dir_link or entry.is_file():
+                relative_path = entry.path[root_len:]
+                # Directories are matched with a trailing slash, so directory patterns such as node_modules/ match
+                # the directory itself and its whole subtree is pruned. As in git, symlinks are matched as files.
+                gitignore_path = relative_path + "/" if is_dir else relative_path
+                entries.append((entry, is_dir, is_dir_link, relative_path, gitignore_path))
+
+    # Check gitignore first, for all entries of the directory at once, pruning ignored directories before descending
+    ignored = set()
+    if gitignore_spec:
+        ignored = set(gitignore_spec.match_files(gitignore_path for _, _, _, _, gitignore_path in entries))
+
+    nodes = []
+    for entry, is_dir, is_dir_link, relative_path, gitignore_path in entries:
+        if gitignore_path in ignored:
+            continue
+
+        path = entry.path
+        name = entry.name
+
+        if is_dir or is_dir_link:
+            if not tree_filter.accept_dir(relative_path):
+                continue
+            if is_dir_link:
+                nodes.append(TreeNode(name, path, False))
+                continue
+            entry_include_content = include_content and content_filter.accept_dir(relative_path)
+            nodes.append(TreeNode(name, path, is_dir, include_content=entry_include_content))
+        else:
+            if not tree_filter.accept_file(path, relative_path, name):
+                continue
+            entry_include_content = include_content and content_filter.accept_file(path, relative_path, name)
+            status = None
+            if is_file_empty(path, entry.stat().st_size):
+                status = "empty"
+            elif is_binary_file(path):
+                status = "binary"
+            elif entry_include_content:
+                status = "content"
+            nodes.append(TreeNode(name, path, is_dir, status=status))
+    return nodes
+
+
+def scan_tree(
         root_path: Path,
-        gitignore_spec: Optional[pathspec.PathSpec],
-        include_dirs: List[str],
-        exclude_dirs: List[str],
-        include_files: List[str],
-        exclude_files: List[str],
-        include_extensions: List[str],
-        exclude_extensions: List[str],
-        include_binary: bool
-) -> bool:
+        gitignore_spec: Optional[pathspec.GitIgnoreSpec],
+        tree_filter: EntryFilter,
+        content_filter: EntryFilter,
+        workers: int = 1
+) -> Dict[str, List[TreeNode]]:
     """
-    Filter a path based on various criteria.
-
-    :param path: Path to the file or directory.
-    :param root_path: Root path for relative calculations.
-    :param gitignore_spec: PathSpec object for .gitignore rules.
-    :param include_dirs: List of directory include patterns.
-    :param exclude_dirs: List of directory exclude patterns.
-    :param include_files: List of file include patterns.
-    :param exclude_files: List of file exclude patterns.
-    :param include_extensions: List of file extension include patterns.
-    :param exclude_extensions: List of file extension exclude patterns.
-    :param include_binary: Whether to include binary files.
-    :return: True if the path passes the filters, False otherwise.
+    Scan all directories below the root path that pass the tree filters.
+
+    With a single worker directories are scanned one at a time, which is fastest on local file systems where reading a
+    directory rarely blocks. More workers scan several directories at a time, which pays off when directory reads
+    have a high latency, such as on network file systems.
+
+    :param root_path: Root path of the scan.
+    :param gitignore_spec: GitIgnoreSpec object for .gitignore rules.
+    :param tree_filter: Filter for the tree.
+    :param content_filter: Filter for the content.
+    :param workers: Number of directories scanned concurrently, which also bounds the number of open directory handles.
+    :return: Dictionary mapping each scanned directory path to its tree nodes.
     """
-    relative_path = path.relative_to(root_path)
-    str_path = str(relative_path)
-
-    # Apply gitignore first
-    if gitignore_spec and gitignore_spec.match_file(path.relative_to(root_path)):
-        return False
+    # Entry paths start with the root path, so relative paths are plain string slices
+    root_len = len(os.path.join(str(root_path), ""))
+    listings: Dict[str, List[TreeNode]] = {}
+
+    if workers == 1:
+        stack = [(str(root_path), True)]
+        while stack:
+            dir_path, include_content = stack.pop()
+            nodes = scan_directory(dir_path, root_len, gitignore_spec, tree_filter, content_filter, include_content)
+            listings[dir_path] = nodes
+            stack.extend((node.path, node.include_content) for node in nodes if node.is_dir)
+        return listings
+
+    pending: Dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(dir_path: str, include_content: bool) -> None:
+            future = executor.submit(scan_directory, dir_path, root_len, gitignore_spec, tree_filter,
+                                     content_filter, include_content)
+            pending[future] = dir_path
 
-    if path.is_dir():
-        if include_dirs:
-            return any(re.search(pattern, str_path) for pattern in include_dirs)
-        if exclude_dirs:
-            return not any(re.search(pattern, str_path) for pattern in exclude_dirs)
-    else:
-        if not include_binary and is_binary_file(path):
-            return False
-        if include_files:
-            return any(re.search(pattern, str_path) or re.search(pattern, path.name) for pattern in include_files)
-        if exclude_files:
-            return not any(re.search(pattern, str_path) or re.search(pattern, path.name) for pattern in exclude_files)
-        if include_extensions:
-            return path.suffix.lstrip('.') in include_extensions
-        if exclude_extensions:
-            return path.suffix.lstrip('.') not in exclude_extensions
-    return True
+        try:
+            submit(str(root_path), True)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path = pending.pop(future)
+                    nodes = future.result()
+                    listings[dir_path] = nodes
+                    for node in nodes:
+                        if node.is_dir:
+                            submit(node.path, node.include_content)
+        except BaseException:
+            # Drop the queued scans instead of running them all before the error, or Ctrl-C, reaches the caller
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return listings
 
 
 def add_to_tree(
         tree: Tree,
-        path: Path,
-        root_path: Path,
-        gitignore_spec: Optional[pathspec.PathSpec],
-        tree_filters: Dict[str, List[str]],
-        content_filters: Dict[str, List[str]]
+        dir_path: str,
+        listings: Dict[str, List[TreeNode]],
+        content_files: List[str]
 ) -> bool:
     """
-    Add a path to a tree structure based on filters.
+    Add the scanned contents of a directory to a tree structure, collecting files whose content should be printed.
 
     :param tree: Tree object to add paths to.
-    :param path: Path to the file or directory.
-    :param root_path: Root path for relative calculations.
-    :param gitignore_spec: PathSpec object for .gitignore rules.
-    :param tree_filters: Dictionary of filters for the tree.
-    :param content_filters: Dictionary of filters for the content.
-    :return: True if the path was added to the tree, False otherwise.
+    :param dir_path: Path to the directory.
+    :param listings: Dictionary mapping each scanned directory path to its tree nodes.
+    :param content_files: List that paths of files passing the content filters are appended to.
+    :return: True if anything was added to the tree, False otherwise.
     """
-    relative_path = path.relative_to(root_path)
+    # Depth-first walk with an explicit stack instead of recursion, so deep trees cannot hit the recursion limit.
+    # A branch is attached to its parent once all of its children were visited, and only if it has any.
+    stack: List[Tuple[Tree, Iterator[TreeNode]]] = [(tree, iter(listings[dir_path]))]
+    while stack:
+        branch, nodes = stack[-1]
+        node = next(nodes, None)
+        if node is None:
+            stack.pop()
+            if stack and branch.children:
+                stack[-1][0].add(branch)
+        elif node.is_dir:
+            stack.append((Tree(node.name), iter(listings[node.path])))
+        else:
+            file_text = Text(node.name)
+            if node.status:
+                file_text.append(f" [{node.status}]", style="dim italic")
+            if node.status == "content":
+                content_files.append(node.path)
+            branch.add(file_text)
+    return len(tree.children) > 0
+
+
+def tree_to_dict(
+        root_name: str,
+        dir_path: str,
+        listings: Dict[str, List[TreeNode]],
+        max_bytes: int
+) -> Dict[str, Any]:
+    """
+    Build a JSON-serializable model of the scanned contents of a directory, with the contents of the files passing the
+    content filters. Directories without any visible entries are left out, as in the rendered tree.
+
+    :param root_name: Name of the root of the model.
+    :param dir_path: Path to the directory.
+    :param listings: Dictionary mapping each scanned directory path to its tree nodes.
+    :param max_bytes: Maximum number of bytes of a file's contents, or 0 for files of any size.
+    :return: Dictionary with the name of the root and its children by name. Directories have children of their own,
+             files have a status, and files passing the content filters also have their contents and whether they were
+             truncated.
+    """
+    root: Dict[str, Any] = {"name": root_name, "children": {}}
+    # Same explicit-stack walk as add_to_tree; a directory is attached to its parent's children once it was visited
+    stack: List[Tuple[Dict[str, Any], Iterator[TreeNode], Optional[Dict[str, Any]], str]] = [
+        (root["children"], iter(listings[dir_path]), None, root_name)
+    ]
+    while stack:
+        children, nodes, parent_children, name = stack[-1]
+        node = next(nodes, None)
+        if node is None:
+            stack.pop()
+            if parent_children is not None and children:
+                parent_children[name] = {"children": children}
+        elif node.is_dir:
+            stack.append(({}, iter(listings[node.path]), children, node.name))
+        else:
+            file_model: Dict[str, Any] = {"status": node.status}
+            if node.status == "content":
+                file_model["content"], file_model["truncated"] = read_file_contents(node.path, max_bytes)
+            children[node.name] = file_model
+    return root
 
-    # Check gitignore first
-    if gitignore_spec and gitignore_spec.match_file(relative_path):
-        return False
 
-    if not filter_path(path, root_path, gitignore_spec, **tree_filters):
-        return False
+def read_file_contents(path: str, max_bytes: int) -> Tuple[str, bool]:
+    """
+    Read the contents of a file, truncating files larger than a maximum size.
 
-    if path.is_file():
-        file_text = Text(path.name)
-        if is_file_empty(path):
-            file_text.append(" [empty]", style="dim italic")
-        elif is_binary_file(path):
-            file_text.append(" [binary]", style="dim italic")
-        elif filter_path(path, root_path, gitignore_spec, **content_filters):
-            file_text.append(" [content]", style="dim italic")
-        tree.add(file_text)
-        return True
-    else:
-        branch = Tree(path.name)
-        has_visible_children = False
-        for child in path.iterdir():
-            if add_to_tree(branch, child, root_path, gitignore_spec, tree_filters, content_filters):
-                has_visible_children = True
-
-        if has_visible_children:
-            tree.add(branch)
-            return True
-        else:
-            return False
+    :param path: Path to the file.
+    :param max_bytes: Maximum number of bytes to read, or 0 to read files of any size.
+    :return: Tuple of the contents and whether they were truncated.
+    """
+    truncated = max_bytes > 0 and os.path.getsize(path) > max_bytes
+    with open(path, 'rb') as f:
+        data = f.read(max_bytes) if truncated else f.read()
+    # Invalid bytes are replaced rather than aborting the run; only a multi-byte character cut off by the truncation
+    # is dropped. Newlines are translated as when reading in text mode.
+    code = codecs.getincrementaldecoder('utf-8')(errors='replace').decode(data, final=not truncated)
+    return code.replace('\r\n', '\n').replace('\r', '\n'), truncated
 
 
-def print_file_contents(path: Path) -> None:
+def print_file_contents(path: str, max_bytes: int) -> None:
     """
-    Print the contents of a file.
+    Print the contents of a file, truncating files larger than a maximum size.
 
     :param path: Path to the file.
+    :param max_bytes: Maximum number of bytes to print, or 0 to print files of any size.
     """
-    if not is_file_empty(path):
+    code, truncated = read_file_contents(path, max_bytes)
+    # Buffer the header, contents and footer so they are written to the output at once
+    with get_console():
         print(f"\n### {path}")
-        syntax = Syntax.from_path(path, line_numbers=True)
-        print(syntax)
+        print(Syntax(code, Syntax.guess_lexer(path, code), line_numbers=True))
+        if truncated:
+            print(Text("... [truncated]", style="dim italic"))
         print(f"### end of {path}\n")
 
 
@@ -230,6 +591,12 @@ def generate_context(
                                          help="Exclude .git directory from analysis"),
         include_binary: bool = typer.Option(False, "--include-binary/--exclude-binary",
                                             help="Include binary files in analysis"),
+        max_file_bytes: int = typer.Option(1024 * 1024, "--max-file-bytes", min=0,
+                                           help="Truncate file contents larger than this many bytes (0 for no limit)"),
+        emit_json: bool = typer.Option(False, "--emit-json",
+                                       help="Output the tree and file contents as JSON instead of rendering them"),
+        scan_workers: int = typer.Option(1, "--scan-workers", min=1,
+                                         help="Directories to scan concurrently, e.g. on network file systems"),
 ) -> None:
     """
     Generate context from codebases for LLMs with exclusive filtering options and .gitignore support.
@@ -237,10 +604,15 @@ def generate_context(
     Include and exclude options are mutually exclusive for each category.
     .gitignore patterns take precedence over other filters and apply to both tree and content.
     Empty files are marked in the tree and excluded from content output.
+    File contents larger than --max-file-bytes are truncated.
+    With --emit-json, the tree and file contents are output as a single JSON object instead.
+    Directories are scanned one at a time unless --scan-workers is greater than 1.
     .git directory and binary files are excluded by default.
     File inclusion/exclusion can be specified by full path or filename.
     """
     try:
+        _binary_cache.clear()
+
         validate_filters(tree_include_dirs, tree_exclude_dirs, "tree directories")
         validate_filters(tree_include_files, tree_exclude_files, "tree files")
         validate_filters(tree_include_extensions, tree_exclude_extensions, "tree extensions")
@@ -250,49 +622,51 @@ def generate_context(
 
         root_path = Path(path).resolve()
         if not root_path.exists():
-            typer.echo(f"Error: Path '{root_path}' does not exist.")
+            typer.echo(f"Error: Path '{root_path}' does not exist.", err=True)
             raise typer.Exit(code=1)
 
-        gitignore_spec = None
         if gitignore:
             gitignore_path = Path(gitignore).resolve()
         else:
             gitignore_path = root_path / ".gitignore"
 
-        if gitignore_path.exists():
-            with gitignore_path.open() as gitignore_file:
-                gitignore_spec = pathspec.PathSpec.from_lines('gitwildmatch', gitignore_file)
-        elif gitignore:
-            typer.echo(f"Warning: Specified .gitignore file at {gitignore_path} does not exist.")
-
-        tree_filters = {
-            "include_dirs": tree_include_dirs or [],
-            "exclude_dirs": tree_exclude_dirs or [],
-            "include_files": tree_include_files or [],
-            "exclude_files": tree_exclude_files or [],
-            "include_extensions": tree_include_extensions or [],
-            "exclude_extensions": tree_exclude_extensions or [],
-            "include_binary": include_binary
-        }
-
-        content_filters = {
-            "include_dirs": (tree_include_dirs or []) + (content_include_dirs or []),
-            "exclude_dirs": (tree_exclude_dirs or []) + (content_exclude_dirs or []),
-            "include_files": (tree_include_files or []) + (content_include_files or []),
-            "exclude_files": (tree_exclude_files or []) + (content_exclude_files or []),
-            "include_extensions": (tree_include_extensions or []) + (content_include_extensions or []),
-            "exclude_extensions": (tree_exclude_extensions or []) + (content_exclude_extensions or []),
-            "include_binary": include_binary
-        }
-
-        if exclude_git:
-            tree_filters["exclude_dirs"].append(r"\.git")
-            content_filters["exclude_dirs"].append(r"\.git")
+        gitignore_spec = parse_gitignore(gitignore_path)
+        if gitignore_spec is None and gitignore:
+            typer.echo(f"Warning: Specified .gitignore file at {gitignore_path} does not exist.", err=True)
+
+        git_dirs = [r"\.git"] if exclude_git else []
+
+        tree_filters = PathFilters.compile(
+            include_dirs=tree_include_dirs or [],
+            exclude_dirs=(tree_exclude_dirs or []) + git_dirs,
+            include_files=tree_include_files or [],
+            exclude_files=tree_exclude_files or [],
+            include_extensions=tree_include_extensions or [],
+            exclude_extensions=tree_exclude_extensions or [],
+            include_binary=include_binary
+        )
+
+        content_filters = PathFilters.compile(
+            include_dirs=(tree_include_dirs or []) + (content_include_dirs or []),
+            exclude_dirs=(tree_exclude_dirs or []) + (content_exclude_dirs or []) + git_dirs,
+            include_files=(tree_include_files or []) + (content_include_files or []),
+            exclude_files=(tree_exclude_files or []) + (content_exclude_files or []),
+            include_extensions=(tree_include_extensions or []) + (content_include_extensions or []),
+            exclude_extensions=(tree_exclude_extensions or []) + (content_exclude_extensions or []),
+            include_binary=include_binary
+        )
+
+        # Generate tree structure, collecting the files to print from the same traversal
+        listings = scan_tree(root_path, gitignore_spec, tree_filters.specialize(), content_filters.specialize(),
+                             scan_workers)
+        if emit_json:
+            model = tree_to_dict(root_path.name, str(root_path), listings, max_file_bytes)
+            typer.echo(json.dumps(model, ensure_ascii=False, indent=2))
+            return
 
-        # Generate tree structure
         tree = Tree(f"[bold]{root_path.name}")
-        for child in root_path.iterdir():
-            add_to_tree(tree, child, root_path, gitignore_spec, tree_filters, content_filters)
+        content_files: List[str] = []
+        add_to_tree(tree, str(root_path), listings, content_files)
 
         if len(tree.children) > 0:
             print(tree)
@@ -300,13 +674,11 @@ def generate_context(
             print("No visible content based on the current filters and .gitignore rules.")
 
         # Print file contents
-        for item in root_path.rglob("*"):
-            if item.is_file() and filter_path(item, root_path, gitignore_spec, **content_filters):
-                if not is_binary_file(item) or include_binary:
-                    print_file_contents(item)
+        for file_path in content_files:
+            print_file_contents(file_path, max_file_bytes)
 
     except Exception as e:
-        typer.echo(f"An error occurred: {str(e)}")
+        typer.echo(f"An error occurred: {str(e)}", err=True)
         raise typer.Exit(code=1)
 
 
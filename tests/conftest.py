@@ -0,0 +1,27 @@
+import os
+
+import pytest
+from typer.testing import CliRunner
+
+from cli import app
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config: pytest.Config) -> None:
+    """
+    Keep temporary test directories on tmpfs when available, unless a base temporary directory was given explicitly.
+    Only the root of pytest's temporary directories is moved, so every run still gets its own numbered directory and
+    the directories of the last runs are kept.
+
+    :param config: pytest configuration.
+    """
+    if config.option.basetemp is None and os.path.isdir("/dev/shm"):
+        os.environ.setdefault("PYTEST_DEBUG_TEMPROOT", "/dev/shm")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _warm_cli() -> None:
+    """
+    Invoke the CLI application once before any test, so that its one-time initialization is not paid inside a test.
+    """
+    CliRunner().invoke(app, ["--help"], catch_exceptions=False)
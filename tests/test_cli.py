@@ -1,192 +1,428 @@
+"""
+Tests of the CLI application.
+
+Every test captures the application output itself, through CliRunner or run_direct, so pytest's own output capture is
+disabled for this module with the _nocapture fixture: otherwise everything printed would be captured twice. The
+tradeoff is that anything printed outside of those captures, such as debugging prints, goes straight to the terminal
+instead of being reported with the failing test.
+"""
+import functools
+import inspect
+import io
+import json
+import os
+import random
+import re
+import shutil
+import time
+from contextlib import redirect_stderr, redirect_stdout
 from pathlib import Path
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Union
 
+import pathspec
 import pytest
 from typer.testing import CliRunner
 
-from cli import app
+import cli
+from cli import app, compile_patterns, generate_context, PathFilters, scan_tree, search_function
 
+pytestmark = pytest.mark.usefixtures("_nocapture")
 
-@pytest.fixture
-def runner() -> CliRunner:
+
+@functools.lru_cache(maxsize=None)
+def _needles_pattern(needles: FrozenSet[str]) -> re.Pattern:
     """
-    Fixture to create a CliRunner instance.
+    Compile a pattern finding all the given substrings in a single scan.
 
-    :return: A CliRunner instance.
+    The alternation sits in a lookahead so that overlapping occurrences are found too, and longer needles come first so
+    that a needle matching at the same position as a longer one is a prefix of the reported match.
+
+    :param needles: Substrings to find.
+    :return: Compiled pattern.
     """
-    return CliRunner()
+    alternatives = sorted(needles, key=len, reverse=True)
+    return re.compile(f"(?=({'|'.join(map(re.escape, alternatives))}))")
 
 
-@pytest.fixture
-def test_dir(tmp_path: Path) -> Path:
+def assert_output(output: str, present: List[str], absent: List[str]) -> None:
     """
-    Fixture to create a test directory structure.
+    Assert that the output contains all present substrings and none of the absent ones, scanning it only once.
 
-    :param tmp_path: Temporary path provided by pytest.
-    :return: Path to the created test directory.
+    :param output: Output of the CLI application.
+    :param present: Substrings that must occur in the output.
+    :param absent: Substrings that must not occur in the output.
     """
-    top = tmp_path / "top"
-    top.mkdir()
-    (top / "file1.txt").write_text("Content of file1")
-    (top / "file2.py").write_text("print('Hello')")
+    found = set(_needles_pattern(frozenset(present) | frozenset(absent)).findall(output))
 
-    level1 = top / "level1"
-    level1.mkdir()
-    (level1 / "file3.txt").write_text("Content of file3")
+    def occurs(needle: str) -> bool:
+        return any(match.startswith(needle) for match in found)
 
-    app = level1 / "app"
-    app.mkdir()
-    (app / "main.py").write_text("def main():\n    pass")
+    missing = [needle for needle in present if not occurs(needle)]
+    unexpected = [needle for needle in absent if occurs(needle)]
+    assert not missing and not unexpected, f"Missing: {missing}, unexpected: {unexpected}"
 
-    top_app = top / "app"
-    top_app.mkdir()
-    (top_app / "main.py").write_text("def top_main():\n    pass")
 
-    return tmp_path
+def lineset(output: str) -> FrozenSet[str]:
+    """
+    Split the output into its set of lines, for assertions on whole lines such as those of the tree.
+
+    :param output: Output of the CLI application.
+    :return: Lines of the output.
+    """
+    return frozenset(output.splitlines())
+
+
+_DIRECT_DEFAULTS = {
+    name: parameter.default.default for name, parameter in inspect.signature(generate_context).parameters.items()
+}
 
 
-def test_default_behavior(runner: CliRunner, test_dir: Path) -> None:
+def run_direct(**kwargs: Any) -> str:
     """
-    Test the default behavior of the CLI application.
+    Call the command function directly, bypassing Click's argument parsing, and capture what it prints.
+    Parameters that are not given take the defaults declared on the Typer options.
 
-    :param runner: CliRunner instance.
-    :param test_dir: Path to the test directory.
+    :param kwargs: Already parsed arguments of generate_context.
+    :return: Captured standard output.
     """
-    result = runner.invoke(app, [str(test_dir)])
-    assert result.exit_code == 0
-    assert "top" in result.output
-    assert "├── file1.txt [content]" in result.output
-    assert "├── file2.py [content]" in result.output
-    assert "├── level1" in result.output
-    assert "│   ├── file3.txt [content]" in result.output
-    assert "│   └── app" in result.output
-    assert "│       └── main.py [content]" in result.output
-    assert "└── app" in result.output
-    assert "    └── main.py [content]" in result.output
-    assert "Content of file1" in result.output
-    assert "print('Hello')" in result.output
-    assert "Content of file3" in result.output
-    assert "def main():" in result.output
-    assert "def top_main():" in result.output
-
-
-def test_tree_filter_only(runner: CliRunner, test_dir: Path) -> None:
-    """
-    Test the tree filter functionality of the CLI application.
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        generate_context(**{**_DIRECT_DEFAULTS, **kwargs})
+    return buffer.getvalue()
 
-    :param runner: CliRunner instance.
-    :param test_dir: Path to the test directory.
+
+def run_json(**kwargs: Any) -> Dict[str, Any]:
     """
-    result = runner.invoke(app, [str(test_dir), "--tree-include-dir", "level1"])
-    assert result.exit_code == 0
-    assert "top" in result.output
-    assert "└── level1" in result.output
-    assert "    ├── file3.txt [content]" in result.output
-    assert "    └── app" in result.output
-    assert "        └── main.py [content]" in result.output
-    assert "file1.txt" not in result.output
-    assert "file2.py" not in result.output
-    assert "Content of file1" in result.output
-    assert "print('Hello')" in result.output
-    assert "Content of file3" in result.output
-    assert "def main():" in result.output
-    assert "def top_main():" in result.output
+    Call the command function directly with --emit-json and parse its output.
+
+    :param kwargs: Already parsed arguments of generate_context.
+    :return: JSON model of the tree.
+    """
+    return json.loads(run_direct(emit_json=True, **kwargs))
 
 
-def test_content_filter_only(runner: CliRunner, test_dir: Path) -> None:
+def flatten(model: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
     """
-    Test the content filter functionality of the CLI application.
+    Flatten the JSON model of a tree into its entries by path relative to the root.
 
-    :param runner: CliRunner instance.
-    :param test_dir: Path to the test directory.
+    :param model: JSON model of the tree, or of one of its directories.
+    :return: Dictionary mapping the relative path of each entry to its model.
     """
-    result = runner.invoke(app, [str(test_dir), "--content-include-ext", "py"])
-    assert result.exit_code == 0
-    assert "top" in result.output
-    assert "├── file1.txt" in result.output
-    assert "├── file2.py [content]" in result.output
-    assert "├── level1" in result.output
-    assert "│   ├── file3.txt" in result.output
-    assert "│   └── app" in result.output
-    assert "│       └── main.py [content]" in result.output
-    assert "└── app" in result.output
-    assert "    └── main.py [content]" in result.output
-    assert "Content of file1" not in result.output
-    assert "Content of file3" not in result.output
-    assert "print('Hello')" in result.output
-    assert "def main():" in result.output
-    assert "def top_main():" in result.output
-
-
-def test_tree_and_content_filter(runner: CliRunner, test_dir: Path) -> None:
-    """
-    Test the combination of tree and content filters in the CLI application.
+    entries = {}
+    for name, entry in model["children"].items():
+        entries[name] = entry
+        if "children" in entry:
+            entries.update({f"{name}/{path}": child for path, child in flatten(entry).items()})
+    return entries
 
-    :param runner: CliRunner instance.
-    :param test_dir: Path to the test directory.
+
+@pytest.fixture
+def _nocapture(capsys: pytest.CaptureFixture) -> Iterator[None]:
     """
-    result = runner.invoke(app, [str(test_dir), "--tree-include-dir", "level1", "--content-include-ext", "txt"])
-    assert result.exit_code == 0
-    assert "top" in result.output
-    assert "└── level1" in result.output
-    assert "    ├── file3.txt [content]" in result.output
-    assert "    └── app" in result.output
-    assert "        └── main.py" in result.output
-    assert "file1.txt [content]" in result.output
-    assert "file2.py" not in result.output
-    assert "Content of file1" in result.output
-    assert "Content of file3" in result.output
-    assert "print('Hello')" not in result.output
-    assert "def main():" not in result.output
-    assert "def top_main():" not in result.output
+    Fixture to disable pytest's output capture during a test, whose output is already captured by the test itself.
+
+    :param capsys: pytest system-level capture fixture.
+    """
+    with capsys.disabled():
+        yield
 
 
-def test_content_filter_adds_to_tree(runner: CliRunner, test_dir: Path) -> None:
+@pytest.fixture(scope="module")
+def runner() -> CliRunner:
     """
-    Test that content filters can add files to the tree structure in the CLI application.
+    Fixture to create a CliRunner instance, shared by the tests of the module since it holds no state between calls.
 
-    :param runner: CliRunner instance.
-    :param test_dir: Path to the test directory.
+    :return: A CliRunner instance.
     """
-    result = runner.invoke(app, [str(test_dir), "--tree-include-dir", "level1", "--content-include-file", "file1.txt"])
-    assert result.exit_code == 0
-    assert "top" in result.output
-    assert "├── file1.txt [content]" in result.output
-    assert "└── level1" in result.output
-    assert "    ├── file3.txt" in result.output
-    assert "    └── app" in result.output
-    assert "        └── main.py" in result.output
-    assert "file2.py" not in result.output
-    assert "Content of file1" in result.output
-    assert "Content of file3" not in result.output
-    assert "print('Hello')" not in result.output
-    assert "def main():" not in result.output
-    assert "def top_main():" not in result.output
+    return CliRunner()
 
 
-def test_gitignore_support(runner: CliRunner, test_dir: Path) -> None:
+def _fast_write(path: Union[Path, str], data: bytes, dir_fd: Optional[int] = None) -> None:
     """
-    Test the .gitignore support in the CLI application.
+    Write bytes to a file with a single unbuffered write, skipping the text layer of Path.write_text.
 
-    :param runner: CliRunner instance.
-    :param test_dir: Path to the test directory.
+    :param path: Path of the file to write, relative to dir_fd if given.
+    :param data: Content to write.
+    :param dir_fd: Open file descriptor of the directory to create the file in.
     """
-    gitignore = test_dir / "top" / ".gitignore"
-    gitignore.write_text("*.txt\n")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644, dir_fd=dir_fd)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
 
-    result = runner.invoke(app, [str(test_dir / "top"), "--gitignore", str(gitignore)])
-    assert result.exit_code == 0
-    assert "top" in result.output
-    assert "├── file2.py [content]" in result.output
-    assert "├── level1" in result.output
-    assert "│   └── app" in result.output
-    assert "│       └── main.py [content]" in result.output
-    assert "└── app" in result.output
-    assert "    └── main.py [content]" in result.output
-    assert "file1.txt" not in result.output
-    assert "file3.txt" not in result.output
-    assert "print('Hello')" in result.output
-    assert "def main():" in result.output
-    assert "def top_main():" in result.output
+
+# Files of the test directory structure, by directory; parents are listed before their subdirectories
+_TEST_TREE: Dict[str, Dict[str, bytes]] = {
+    "top": {"file1.txt": b"Content of file1", "file2.py": b"print('Hello')"},
+    "top/level1": {"file3.txt": b"Content of file3"},
+    "top/level1/app": {"main.py": b"def main():\n    pass"},
+    "top/app": {"main.py": b"def top_main():\n    pass"},
+}
+
+
+@pytest.fixture(scope="session")
+def test_dir(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """
+    Fixture to create a test directory structure, shared by all tests of the session.
+    Tests must not modify it; tests that add files use test_dir_rw instead.
+
+    :param tmp_path_factory: Temporary path factory provided by pytest.
+    :return: Path to the created test directory.
+    """
+    tmp_path = tmp_path_factory.mktemp("test_dir")
+    for directory, files in _TEST_TREE.items():
+        dir_path = tmp_path / directory
+        dir_path.mkdir()
+        # Create the files relative to the open directory so that its path is only resolved once
+        dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for name, data in files.items():
+                _fast_write(name, data, dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    return tmp_path
+
+
+@pytest.fixture
+def test_dir_rw(test_dir: Path, tmp_path: Path) -> Path:
+    """
+    Fixture to create a per-test copy of the test directory structure that tests may add files to.
+    The files of the copy are hard links to the shared test directory, so existing files must not be modified.
+
+    :param test_dir: Path to the shared test directory.
+    :param tmp_path: Temporary path provided by pytest.
+    :return: Path to the copied test directory.
+    """
+    copy = tmp_path / "test_dir"
+    shutil.copytree(test_dir, copy, copy_function=os.link, dirs_exist_ok=True)
+    return copy
+
+
+@pytest.fixture
+def tree_dir(request: pytest.FixtureRequest, test_dir: Path) -> Path:
+    """
+    Indirect fixture providing the test directory, with the extra files given as its parameter.
+    Without extra files the shared test directory is used, otherwise a writable copy of it.
+
+    :param request: pytest request, whose parameter maps relative file paths to their content.
+    :param test_dir: Path to the shared test directory.
+    :return: Path to the test directory to run on.
+    """
+    extra_files: Dict[str, bytes] = request.param
+    if not extra_files:
+        return test_dir
+    copy = request.getfixturevalue("test_dir_rw")
+    for name, data in extra_files.items():
+        _fast_write(copy / name, data)
+    return copy
+
+
+CASES = [
+    pytest.param(
+        {}, ".", {},
+        {
+            "top": None,
+            "top/file1.txt": "content",
+            "top/file2.py": "content",
+            "top/level1": None,
+            "top/level1/file3.txt": "content",
+            "top/level1/app": None,
+            "top/level1/app/main.py": "content",
+            "top/app": None,
+            "top/app/main.py": "content",
+        },
+        [
+            "Content of file1",
+            "print('Hello')",
+            "Content of file3",
+            "def main():",
+            "def top_main():",
+        ],
+        [],
+        id="default",
+    ),
+    pytest.param(
+        {}, "top", {"tree_include_dirs": ["level1"]},
+        {
+            "file1.txt": "content",
+            "file2.py": "content",
+            "level1": None,
+            "level1/file3.txt": "content",
+            "level1/app": None,
+            "level1/app/main.py": "content",
+        },
+        [
+            "Content of file1",
+            "print('Hello')",
+            "Content of file3",
+            "def main():",
+        ],
+        [
+            "def top_main():",
+        ],
+        id="tree_filter_only",
+    ),
+    pytest.param(
+        # Directory patterns are matched against the path relative to the root, so "top" itself is filtered out
+        {}, ".", {"tree_include_dirs": ["level1"]},
+        {},
+        [],
+        [
+            "top",
+        ],
+        id="tree_filter_matches_relative_path",
+    ),
+    pytest.param(
+        {}, ".", {"content_include_extensions": ["py"]},
+        {
+            "top": None,
+            "top/file1.txt": None,
+            "top/file2.py": "content",
+            "top/level1": None,
+            "top/level1/file3.txt": None,
+            "top/level1/app": None,
+            "top/level1/app/main.py": "content",
+            "top/app": None,
+            "top/app/main.py": "content",
+        },
+        [
+            "print('Hello')",
+            "def main():",
+            "def top_main():",
+        ],
+        [
+            "Content of file1",
+            "Content of file3",
+        ],
+        id="content_filter_only",
+    ),
+    pytest.param(
+        # Extensions are matched case-insensitively, with or without a leading dot
+        {}, "top", {"tree_include_extensions": [".PY"]},
+        {
+            "file2.py": "content",
+            "level1": None,
+            "level1/app": None,
+            "level1/app/main.py": "content",
+            "app": None,
+            "app/main.py": "content",
+        },
+        [
+            "print('Hello')",
+            "def main():",
+            "def top_main():",
+        ],
+        [
+            "file1.txt",
+            "file3.txt",
+        ],
+        id="tree_extension_filter",
+    ),
+    pytest.param(
+        {}, "top", {"tree_include_dirs": ["level1"], "content_include_extensions": ["txt"]},
+        {
+            "file1.txt": "content",
+            "file2.py": None,
+            "level1": None,
+            "level1/file3.txt": "content",
+            "level1/app": None,
+            "level1/app/main.py": None,
+        },
+        [
+            "Content of file1",
+            "Content of file3",
+        ],
+        [
+            "print('Hello')",
+            "def main():",
+            "def top_main():",
+        ],
+        id="tree_and_content_filter",
+    ),
+    pytest.param(
+        {}, "top", {"tree_include_dirs": ["level1"], "content_include_files": ["file1.txt"]},
+        {
+            "file1.txt": "content",
+            "file2.py": None,
+            "level1": None,
+            "level1/file3.txt": None,
+            "level1/app": None,
+            "level1/app/main.py": None,
+        },
+        [
+            "Content of file1",
+        ],
+        [
+            "Content of file3",
+            "print('Hello')",
+            "def main():",
+            "def top_main():",
+        ],
+        id="tree_and_content_file_filter",
+    ),
+    pytest.param(
+        {"top/.gitignore": b"*.txt\n"}, "top", {"gitignore": Path("top/.gitignore")},
+        {
+            ".gitignore": "content",
+            "file2.py": "content",
+            "level1": None,
+            "level1/app": None,
+            "level1/app/main.py": "content",
+            "app": None,
+            "app/main.py": "content",
+        },
+        [
+            "print('Hello')",
+            "def main():",
+            "def top_main():",
+        ],
+        [
+            "file1.txt",
+            "file3.txt",
+        ],
+        id="gitignore_support",
+    ),
+]
+
+
+@pytest.mark.parametrize("tree_dir, path, options, entries, present, absent", CASES, indirect=["tree_dir"])
+def test_filters(tree_dir: Path, monkeypatch: pytest.MonkeyPatch, path: str, options: Dict[str, Any],
+                 entries: Dict[str, Optional[str]], present: List[str], absent: List[str]) -> None:
+    """
+    Test the tree, content and .gitignore filtering of the CLI application.
+    Paths in the case are relative to the test directory.
+
+    :param tree_dir: Path to the test directory.
+    :param monkeypatch: pytest monkeypatch, used to run from the test directory.
+    :param path: Path to analyze.
+    :param options: Parsed options of the command.
+    :param entries: All the entries of the tree by relative path, with their status (None for directories).
+    :param present: Substrings that must occur in the entry paths or file contents.
+    :param absent: Substrings that must not occur in the entry paths or file contents.
+    """
+    monkeypatch.chdir(tree_dir)
+    tree = flatten(run_json(path=path, **options))
+    statuses = {entry_path: entry.get("status") for entry_path, entry in tree.items()}
+    assert statuses == entries
+    contents = [entry["content"] for entry in tree.values() if "content" in entry]
+    assert_output("\n".join([*tree, *contents]), present, absent)
+
+
+def test_render(tmp_path: Path) -> None:
+    """
+    Test the rendering of the tree and of the file contents.
+
+    :param tmp_path: Temporary path provided by pytest.
+    """
+    main = tmp_path / "src" / "main.py"
+    main.parent.mkdir()
+    _fast_write(main, b"def main():\n    pass")
+
+    output = run_direct(path=str(tmp_path))
+    assert not {tmp_path.name, "└── src", "    └── main.py [content]"} - lineset(output)
+    assert_output(output, present=[f"### {main}", "def main():", f"### end of {main}"], absent=[])
 
 
 def test_empty_directory(runner: CliRunner, tmp_path: Path) -> None:
@@ -196,9 +432,15 @@ def test_empty_directory(runner: CliRunner, tmp_path: Path) -> None:
     :param runner: CliRunner instance.
     :param tmp_path: Temporary path provided by pytest.
     """
-    result = runner.invoke(app, [str(tmp_path)])
+    result = runner.invoke(app, [str(tmp_path)], catch_exceptions=False)
     assert result.exit_code == 0
-    assert "No visible content based on the current filters and .gitignore rules." in result.output
+    assert_output(
+        result.output,
+        present=[
+            "No visible content based on the current filters and .gitignore rules.",
+        ],
+        absent=[],
+    )
 
 
 def test_nonexistent_directory(runner: CliRunner) -> None:
@@ -207,9 +449,9 @@ def test_nonexistent_directory(runner: CliRunner) -> None:
 
     :param runner: CliRunner instance.
     """
-    result = runner.invoke(app, ["/path/that/does/not/exist"])
+    result = runner.invoke(app, ["/path/that/does/not/exist"], catch_exceptions=False)
     assert result.exit_code == 1
-    assert "Error: Path '/path/that/does/not/exist' does not exist." in result.output
+    assert_output(result.output, present=["Error: Path '/path/that/does/not/exist' does not exist."], absent=[])
 
 
 def test_include_exclude_conflict(runner: CliRunner, test_dir: Path) -> None:
@@ -219,42 +461,239 @@ def test_include_exclude_conflict(runner: CliRunner, test_dir: Path) -> None:
     :param runner: CliRunner instance.
     :param test_dir: Path to the test directory.
     """
-    result = runner.invoke(app, [str(test_dir), "--tree-include-dir", "level1", "--tree-exclude-dir", "app"])
+    result = runner.invoke(app, [str(test_dir), "--tree-include-dir", "level1", "--tree-exclude-dir", "app"],
+                           catch_exceptions=False)
     assert result.exit_code == 1
-    assert "Error: Cannot specify both include and exclude for tree directories." in result.output
+    assert_output(
+        result.output,
+        present=[
+            "Error: Cannot specify both include and exclude for tree directories.",
+        ],
+        absent=[],
+    )
 
 
-def test_binary_file_handling(runner: CliRunner, test_dir: Path) -> None:
+def test_binary_file_handling(test_dir_rw: Path) -> None:
     """
     Test the behavior of the CLI application with binary files.
 
-    :param runner: CliRunner instance.
-    :param test_dir: Path to the test directory.
+    :param test_dir_rw: Path to the writable copy of the test directory.
     """
-    binary_file = test_dir / "top" / "binary.bin"
+    binary_file = test_dir_rw / "top" / "binary.bin"
     binary_file.write_bytes(b'\x00\x01\x02\x03')
 
-    result = runner.invoke(app, [str(test_dir), "--include-binary"])
-    assert result.exit_code == 0
-    assert "top" in result.output
-    assert "└── binary.bin [binary]" in result.output
+    tree = flatten(run_json(path=str(test_dir_rw), include_binary=True))
+    assert tree["top/binary.bin"] == {"status": "binary"}
 
-    result = runner.invoke(app, [str(test_dir)])  # Default behavior (exclude binary)
-    assert result.exit_code == 0
-    assert "binary.bin" not in result.output
+    tree = flatten(run_json(path=str(test_dir_rw)))  # Default behavior (exclude binary)
+    assert "top/binary.bin" not in tree
+
+
+def test_non_utf8_file_handling(test_dir_rw: Path) -> None:
+    """
+    Test that files with content that is not valid UTF-8 are handled as binary files.
+
+    :param test_dir_rw: Path to the writable copy of the test directory.
+    """
+    _fast_write(test_dir_rw / "top" / "NOTES", "café\n".encode("latin-1"))
+
+    tree = flatten(run_json(path=str(test_dir_rw), include_binary=True))
+    assert tree["top/NOTES"] == {"status": "binary"}
+
+    tree = flatten(run_json(path=str(test_dir_rw)))
+    assert "top/NOTES" not in tree
 
 
-def test_empty_file_handling(runner: CliRunner, test_dir: Path) -> None:
+def test_file_filters_skip_binary_check(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that files rejected by the file filters are not opened to check whether they are binary.
+
+    :param tmp_path: Temporary path provided by pytest.
+    :param monkeypatch: pytest monkeypatch, used to record binary checks.
+    """
+    for i in range(20):
+        _fast_write(tmp_path / f"data{i}", b"x")
+    _fast_write(tmp_path / "wanted.py", b"x")
+    is_binary_file = cli.is_binary_file
+    checked = []
+
+    def recording_is_binary_file(file_path: str) -> bool:
+        checked.append(os.path.basename(file_path))
+        return is_binary_file(file_path)
+
+    monkeypatch.setattr(cli, "is_binary_file", recording_is_binary_file)
+    for include_files, exclude_files in ((["^wanted"], []), ([], ["^data"])):
+        checked.clear()
+        accept_file = PathFilters.compile([], [], include_files, exclude_files, [], [], include_binary=False).specialize()
+        scan_tree(tmp_path, None, accept_file, accept_file)
+        assert set(checked) == {"wanted.py"}
+
+
+def test_symlinked_directory_handling(test_dir_rw: Path) -> None:
+    """
+    Test that symlinked directories are listed without being followed.
+
+    :param test_dir_rw: Path to the writable copy of the test directory.
+    """
+    (test_dir_rw / "top" / "linkdir").symlink_to(test_dir_rw / "top" / "level1", target_is_directory=True)
+
+    tree = flatten(run_json(path=str(test_dir_rw)))
+    assert tree["top/linkdir"] == {"status": None}
+    assert not any(path.startswith("top/linkdir/") for path in tree)
+
+
+def test_empty_file_handling(test_dir_rw: Path) -> None:
     """
     Test the behavior of the CLI application with empty files.
 
+    :param test_dir_rw: Path to the writable copy of the test directory.
+    """
+    empty_file = test_dir_rw / "top" / "empty.txt"
+    empty_file.touch()
+    _fast_write(test_dir_rw / "top" / "blank.txt", b"  \n\t\n")
+    # Only whitespace in the first chunk read, followed by content
+    _fast_write(test_dir_rw / "top" / "late.txt", b" " * 70000 + b"content")
+
+    tree = flatten(run_json(path=str(test_dir_rw)))
+    assert tree["top/empty.txt"] == {"status": "empty"}
+    assert tree["top/blank.txt"] == {"status": "empty"}
+    assert tree["top/late.txt"]["status"] == "content"
+
+
+def test_max_file_bytes(test_dir: Path) -> None:
+    """
+    Test that file contents larger than --max-file-bytes are truncated.
+
+    :param test_dir: Path to the test directory.
+    """
+    tree = flatten(run_json(path=str(test_dir), max_file_bytes=7))
+    assert tree["top/file1.txt"] == {"status": "content", "content": "Content", "truncated": True}
+    assert tree["top/level1/app/main.py"] == {"status": "content", "content": "def mai", "truncated": True}
+
+
+def test_emit_json_with_warning(test_dir: Path) -> None:
+    """
+    Test that warnings go to standard error, so that the output of --emit-json stays valid JSON.
+
+    :param test_dir: Path to the test directory.
+    """
+    errors = io.StringIO()
+    with redirect_stderr(errors):
+        output = run_direct(path=str(test_dir), gitignore=test_dir / "missing" / ".gitignore", emit_json=True)
+    assert "top" in json.loads(output)["children"]
+    assert "Warning: Specified .gitignore file" in errors.getvalue()
+
+
+def test_negative_max_file_bytes(runner: CliRunner, test_dir: Path) -> None:
+    """
+    Test that a negative --max-file-bytes is rejected.
+
     :param runner: CliRunner instance.
     :param test_dir: Path to the test directory.
     """
-    empty_file = test_dir / "top" / "empty.txt"
-    empty_file.touch()
+    result = runner.invoke(app, [str(test_dir), "--max-file-bytes", "-1"], catch_exceptions=False)
+    assert result.exit_code == 2
 
-    result = runner.invoke(app, [str(test_dir)])
-    assert result.exit_code == 0
-    assert "top" in result.output
-    assert "└── empty.txt [empty]" in result.output
+
+def test_invalid_utf8_contents(test_dir_rw: Path) -> None:
+    """
+    Test that invalid UTF-8 in a text file is replaced instead of aborting the run, whether truncated or not.
+
+    :param test_dir_rw: Path to the writable copy of the test directory.
+    """
+    _fast_write(test_dir_rw / "top" / "notes.txt", b"caf\xe9 ok\n")
+
+    tree = flatten(run_json(path=str(test_dir_rw)))
+    assert tree["top/notes.txt"] == {"status": "content", "content": "caf\ufffd ok\n", "truncated": False}
+
+    tree = flatten(run_json(path=str(test_dir_rw), max_file_bytes=5))
+    assert tree["top/notes.txt"] == {"status": "content", "content": "caf\ufffd ", "truncated": True}
+
+
+def test_concurrent_scan(test_dir: Path) -> None:
+    """
+    Test that scanning several directories at a time gives the same result as scanning them one at a time.
+
+    :param test_dir: Path to the test directory.
+    """
+    assert run_json(path=str(test_dir), scan_workers=4) == run_json(path=str(test_dir))
+
+
+def test_concurrent_scan_error_cancels_queued_scans(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that an error while scanning several directories at a time does not wait for the queued scans to run.
+
+    :param tmp_path: Temporary path provided by pytest.
+    :param monkeypatch: pytest monkeypatch, used to make directory scans fail.
+    """
+    for i in range(200):
+        (tmp_path / f"dir{i}").mkdir()
+    scan_directory = cli.scan_directory
+    calls = []
+
+    def failing_scan_directory(dir_path: str, *args: Any) -> List[cli.TreeNode]:
+        calls.append(dir_path)
+        if dir_path == str(tmp_path):
+            return scan_directory(dir_path, *args)
+        time.sleep(0.01)
+        raise PermissionError(dir_path)
+
+    monkeypatch.setattr(cli, "scan_directory", failing_scan_directory)
+    accept_all = PathFilters.compile([], [], [], [], [], [], include_binary=True).specialize()
+    with pytest.raises(PermissionError):
+        scan_tree(tmp_path, None, accept_all, accept_all, workers=2)
+    assert len(calls) < 50
+
+
+def test_compile_patterns_keeps_pattern_semantics(test_dir: Path) -> None:
+    """
+    Test that filter patterns with global inline flags or numbered backreferences behave as they do on their own.
+
+    :param test_dir: Path to the test directory.
+    """
+    assert search_function(compile_patterns(["(?i)readme", "setup"]))("README.md")
+    assert search_function(compile_patterns([r"(a)\1", r"(b)\1"]))("bb")
+    assert not search_function(compile_patterns([r"(a)\1", r"(b)\1"]))("ab")
+    assert search_function(compile_patterns(["foo", "bar"]))("xbar")
+
+    tree = flatten(run_json(path=str(test_dir), tree_include_files=["(?i)FILE1", "file2"]))
+    assert {"top/file1.txt", "top/file2.py"} <= tree.keys()
+    assert "top/level1/file3.txt" not in tree
+
+
+def test_gitignore_scan_matches_pathspec(tmp_path: Path) -> None:
+    """
+    Test that scanning random trees with random .gitignore rules, including negated, ** and */ patterns, leaves out
+    exactly the entries that pathspec ignores, when ignored directories are not descended into.
+
+    :param tmp_path: Temporary path provided by pytest.
+    """
+    rng = random.Random(0)
+    pattern_pool = ["*.txt", "!*.txt", "**", "!**", "**/", "!**/", "*/", "!*/", "a/", "!a/", "!sub/", "a/**", "!a/b/",
+                    "b", "!b", "**/c", "!keep*", "a/*.py", "/b", "*.py", "!f.py", "c/*", "!g.txt"]
+    accept_all = PathFilters.compile([], [], [], [], [], [], include_binary=True).specialize()
+    for case in range(200):
+        root = tmp_path / f"case{case}"
+        root.mkdir()
+        for _ in range(rng.randint(1, 8)):
+            directory = root.joinpath(*rng.choices(["a", "b", "c", "sub"], k=rng.randint(0, 3)))
+            directory.mkdir(parents=True, exist_ok=True)
+            _fast_write(directory / rng.choice(["keep.txt", "f.py", "g.txt", "root"]), b"x")
+        lines = rng.choices(pattern_pool, k=rng.randint(1, 4))
+        spec = pathspec.GitIgnoreSpec.from_lines(lines)
+
+        listings = scan_tree(root, spec, accept_all, accept_all)
+        scanned = {os.path.relpath(node.path, root) for nodes in listings.values() for node in nodes}
+
+        expected = set()
+        pending = [root]
+        while pending:
+            for entry in pending.pop().iterdir():
+                relative_path = entry.relative_to(root).as_posix()
+                if entry.is_dir():
+                    if not spec.match_file(relative_path + "/"):
+                        expected.add(relative_path)
+                        pending.append(entry)
+                elif not spec.match_file(relative_path):
+                    expected.add(relative_path)
+        assert scanned == expected, lines